@@ -1,11 +1,20 @@
 import os
+import re
+import sys
 import errno
-import json
+import fnmatch
+import concurrent.futures
 import shutil
+import threading
 import pathlib
-from typing import Union, Dict, List, Callable, Iterable, Iterator, Any
+import functools
+from typing import (
+    Union, Optional, Dict, List, Tuple, Callable, Iterable, Iterator, Any,
+    TextIO
+)
 
 import docker
+import orjson
 from git import Repo
 from termcolor import colored
 
@@ -20,25 +29,67 @@ BUILD_DIR_ROOT = REPO_MAIN_DIR / "build"
 RESUME_SRC_DIR = REPO_MAIN_DIR / "resumé"
 RESUME_OUTPUT_DIR = BUILD_DIR_ROOT / "resumé"
 
+_UID = os.getuid()
+_GID = os.getgid()
+_UID_STR = str(_UID)
+_GID_STR = str(_GID)
+
 
 REPO = Repo(REPO_MAIN_DIR)
 assert not REPO.bare
 
-DOCKER_CLIENT = docker.APIClient(base_url="unix://var/run/docker.sock")
+# Single long-lived client shared by all tasks. There is only one host
+# (the daemon socket), so it is the per host connections limit which
+# bounds how many requests may be in flight at once
+DOCKER_CLIENT = docker.APIClient(
+    base_url="unix://var/run/docker.sock",
+    max_pool_size=16,
+    timeout=600
+)
+
+_RESUME_VOLUMES = ["/code", "/_/resources", "/_/output"]
+_RESUME_HOST_CONFIG = DOCKER_CLIENT.create_host_config(
+    privileged=True,
+    binds={
+        RESUME_SRC_DIR: {"bind": "/code", "mode": "ro"},
+        RESOURCES_DIR: {"bind": "/_/resources", "mode": "ro"},
+        RESUME_OUTPUT_DIR: {"bind": "/_/output", "mode": "rw"}
+    }
+)
+
 DOIT_CONFIG = {"default_tasks": ["build_all_images"]}
 
+_UNITS = [
+    (1, "B"),
+    (1024, "KB"),
+    (1024 ** 2, "MB"),
+    (1024 ** 3, "GB"),
+    (1024 ** 4, "TB")
+]
+
+# How often build output is flushed to terminal
+_FLUSH_EVERY_LINES = 64
+
+# Matches a build log line holding only a JSON string in "stream" key
+_STREAM_LINE_RE = re.compile(rb'^\{"stream":("(?:[^"\\]|\\.)*")\}\s*$')
+
 # Don't modify this variables manually
 IMAGE_BUILD_TASKS = []
+IMAGE_BUILDERS = []
 IMAGE_CLEAN_TASKS = []
+CLEAN_HOOKS = []
 
 
+@functools.lru_cache(maxsize=1)
 def get_current_branch():
-    try:
-        return os.environ["CI_COMMIT_REF_NAME"]
-    except KeyError:
-        return REPO.head.ref.name
+    ci_branch = os.environ.get("CI_COMMIT_REF_NAME")
+    if ci_branch:
+        return ci_branch
 
+    return REPO.head.ref.name
 
+
+@functools.lru_cache(maxsize=1)
 def get_version():
     head_commit_datetime = REPO.head.commit.authored_datetime
     head_commit_hash = REPO.head.commit.hexsha
@@ -61,31 +112,66 @@ def create_dir_if_not_exists(path_to_dir: str) -> bool:
         return False
 
 
+@functools.lru_cache(maxsize=1)
+def _changed_paths() -> List[str]:
+    """Return paths reported by a single `git status` of the whole repo."""
+    output = REPO.git.status("--porcelain", "-z", "--untracked-files=all")
+    entries = iter(output.split("\0"))
+
+    result = []
+    for entry in entries:
+        if not entry:
+            continue
+
+        status, path = entry[:2], entry[3:]
+        result.append(path)
+        # Renamed and copied entries are followed by their original path
+        if "R" in status or "C" in status:
+            result.append(next(entries, ""))
+
+    return result
+
+
 def is_dir_modified(relative_path_to_dir: str) -> bool:
     path = os.path.normpath(relative_path_to_dir)
-    is_files_modified = len(REPO.index.diff(None, path)) != 0
-    is_new_files_added = any(untracked_file.startswith(path)
-                             for untracked_file in REPO.untracked_files)
+    if path == os.curdir:
+        return len(_changed_paths()) != 0
 
-    return is_files_modified or is_new_files_added
+    dir_prefix = path + "/"
+    return any(changed_path == path or changed_path.startswith(dir_prefix)
+               for changed_path in _changed_paths())
 
 
-def get_all_tasks() -> List[Callable]:
-    result = []
-    for name, value in globals().items():
-        if name.startswith("task_"):
-            result.append(value)
+def register_clean_hook(func: Callable) -> Callable:
+    """Make `func` to be called by cleanup task."""
+    CLEAN_HOOKS.append(func)
+    return func
 
-    return result
 
+def delete_matching(path: pathlib.Path, patterns: List[str]) -> None:
+    """Remove files and dirs under `path` matching any of glob `patterns`.
 
-def delete_using_rglob(path: pathlib.Path, pattern: str) -> None:
-    for path in REPO_MAIN_DIR.rglob(pattern):
-        print(path)
-        if path.is_dir():
-            path.rmdir()
-        else:
-            path.unlink()
+    Tree is walked only once for all patterns and entry types are taken
+    from directory listing, so no extra stat call is made per entry.
+    """
+    def is_matched(name: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+
+        for dirname in [name for name in dirnames if is_matched(name)]:
+            dirnames.remove(dirname)
+            full_path = os.path.join(dirpath, dirname)
+            print(full_path)
+            shutil.rmtree(full_path, ignore_errors=True)
+
+        for filename in filenames:
+            if is_matched(filename):
+                full_path = os.path.join(dirpath, filename)
+                print(full_path)
+                os.unlink(full_path)
 
 
 def get_task_name(task_obj: Union[Callable, str]) -> str:
@@ -103,10 +189,12 @@ def get_cli_handy_task_name(task_func: Union[Callable, str]) -> str:
     return get_cli_handy_string(get_task_name(task_func))
 
 
+@functools.lru_cache(maxsize=32)
 def construct_full_image_name(image_name: str) -> str:
     return f"{PROJECT_PREFIX.lower()}-{image_name}"
 
 
+@functools.lru_cache(maxsize=32)
 def construct_tagged_full_image_name(image_name: str) -> str:
     return f"{construct_full_image_name(image_name)}:{get_version()}"
 
@@ -115,106 +203,190 @@ def start_docker_image_building(
     full_image_name: str,
     path_to_context: str,
     path_to_dockerfile_in_context: str,
-    build_args: Dict[str, str] = {}
-) -> Iterable[str]:
+    build_args: Optional[Dict[str, str]] = None
+) -> Iterable[bytes]:
     info_txt = "Start building {} image".format(full_image_name)
     print(colored(info_txt, "blue", "on_white", attrs=["bold"]))
 
+    final_build_args = {"HOST_USER_UID": _UID_STR, "HOST_USER_GID": _GID_STR}
+    if build_args:
+        final_build_args.update(build_args)
+
     return DOCKER_CLIENT.build(
         path="{}/{}/".format(REPO_MAIN_DIR, path_to_context),
         dockerfile=path_to_dockerfile_in_context,
         rm=True,
         forcerm=True,
-        buildargs={
-            "HOST_USER_UID": str(os.getuid()),
-            "HOST_USER_GID": str(os.getgid()),
-            **build_args
-        },
+        buildargs=final_build_args,
         tag=full_image_name
     )
 
 
+def _format_bytes(B: int) -> Tuple[float, str]:
+    """Return the given bytes as value scaled to the most suitable unit."""
+    # Every unit is 2 ** 10 times bigger than previous one
+    idx = max(0, min(len(_UNITS) - 1, (int(B).bit_length() - 1) // 10))
+    unit_size, unit_name = _UNITS[idx]
+
+    return B / unit_size, unit_name
+
+
 def convert_bytes_to_human_readable(B: int) -> str:
-    """Return the given bytes as a human friendly KB, MB, GB, or TB string."""
-    B = float(B)
-    KB = float(1024)
-    MB = float(KB ** 2)  # 1,048,576
-    GB = float(KB ** 3)  # 1,073,741,824
-    TB = float(KB ** 4)  # 1,099,511,627,776
-
-    if B < KB:
-        return "{0} {1}".format(B, "Bytes" if 0 == B > 1 else "Byte")
-    elif KB <= B < MB:
-        return "{0:.2f} KB".format(B / KB)
-    elif MB <= B < GB:
-        return "{0:.2f} MB".format(B / MB)
-    elif GB <= B < TB:
-        return "{0:.2f} GB".format(B / GB)
-    elif TB <= B:
-        return "{0:.2f} TB".format(B / TB)
+    """Return the given bytes as a human friendly B, KB, MB, GB, TB string."""
+    value, unit = _format_bytes(B)
+    return f"{value:.2f} {unit}"
 
 
 def construct_loading_progress_string(cur_bytes: int, total_bytes: int) -> str:
-    return "{}/{}".format(
-        convert_bytes_to_human_readable(cur_bytes),
-        convert_bytes_to_human_readable(total_bytes)
-    )
+    cur_value, cur_unit = _format_bytes(cur_bytes)
+    total_value, total_unit = _format_bytes(total_bytes)
+
+    return f"{cur_value:.2f} {cur_unit}/{total_value:.2f} {total_unit}"
+
+
+def split_lines(chunks: Iterable[Union[bytes, str]]) -> Iterator[bytes]:
+    """Regroup raw HTTP chunks of docker output into separate lines.
+
+    A single chunk may carry several JSON documents, as well as a part
+    of one. When the response is not chunked, docker-py yields the whole
+    body at once as str.
+    """
+    tail = b""
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        yield from lines
+
+    if tail:
+        yield tail
 
 
 def analyze_and_print_image_building_status(
-        output_iter: Iterable[str]
+        output_iter: Iterable[Union[bytes, str]],
+        out: Optional[TextIO] = None
 ) -> bool:
     """Read and analyze JSON serialized info about status line by line.
+    Writes the info into `out`, which is sys.stdout by default.
     Returns:
         True - if all is good
         False - if error occurs during image building
     """
-    for line in output_iter:
-        data = json.loads(line)
-        if "stream" in data:
-            print(data["stream"], end="")
-        elif "status" in data:
-            layer_status = data["status"]
-
-            if "id" in data:
-                layer_id = data["id"]
-                if ("progressDetail" in data
-                        and "current" in data["progressDetail"]):
-                    bytes_loaded = data["progressDetail"]["current"]
-                    if "total" not in data["progressDetail"]:
-                        print("======", data["progressDetail"])
-
-                    total_bytes = data["progressDetail"]["total"]
-                    progress = construct_loading_progress_string(
-                        bytes_loaded,
-                        total_bytes
-                    )
-
-                    print(f"{layer_id}: {layer_status} {progress}")
+    # sys.stdout is looked up on every call, because doit replaces it
+    # while running task actions
+    out = out or sys.stdout
+    write = out.write
+    flush = out.flush
+    try:
+        for line_no, line in enumerate(split_lines(output_iter), 1):
+            if line_no % _FLUSH_EVERY_LINES == 0:
+                flush()
+
+            # Newer docker daemons may put NUL bytes between JSON documents
+            line = line.lstrip(b"\x00 \t\r\n")
+            if not line:
+                continue
+
+            # Plain build log lines are the most frequent ones, so decode
+            # only their string payload instead of the whole object
+            if line.startswith(b'{"stream"'):
+                match = _STREAM_LINE_RE.match(line)
+                if match:
+                    write(orjson.loads(match.group(1)))
+                    continue
+
+            data = orjson.loads(line)
+            if "stream" in data:
+                write(data["stream"])
+            elif "status" in data:
+                layer_status = data["status"]
+
+                if "id" in data:
+                    layer_id = data["id"]
+                    if ("progressDetail" in data
+                            and "current" in data["progressDetail"]):
+                        bytes_loaded = data["progressDetail"]["current"]
+                        if "total" not in data["progressDetail"]:
+                            write(f"====== {data['progressDetail']}\n")
+
+                        total_bytes = data["progressDetail"]["total"]
+                        progress = construct_loading_progress_string(
+                            bytes_loaded,
+                            total_bytes
+                        )
+
+                        write(f"{layer_id}: {layer_status} {progress}\n")
+                    else:
+                        write(f"{layer_id}: {layer_status}\n")
                 else:
-                    print(f"{layer_id}: {layer_status}")
+                    write(f"{layer_status}\n")
+            elif "error" in data:
+                write(f"{data['error']}\n")
+                return False
             else:
-                print(layer_status)
-        elif "error" in data:
-            print(data["error"])
-            return False
-        else:
-            print(data)
+                write(f"{data}\n")
+    finally:
+        flush()
 
     return True
 
 
 def print_text(generator: Iterator[bytes]) -> None:
-    line = bytearray()
+    write = sys.stdout.write
+    tail = bytearray()
     for obj in generator:
-        line.extend(obj)
-        if chr(line[-1]) == "\n":
-            print(line.decode(), end="")
-            line = bytearray()
+        idx = obj.rfind(b"\n")
+        if idx == -1:
+            tail.extend(obj)
+            continue
+
+        # Print only completed lines and carry the rest over
+        tail.extend(obj[:idx + 1])
+        write(tail.decode())
+        tail = bytearray(obj[idx + 1:])
 
     # Print characters without \n symbol
-    if line:
-        print(line.decode(), end="\n")
+    if tail:
+        write(tail.decode() + "\n")
+
+    sys.stdout.flush()
+
+
+class PrefixedWriter:
+    """Text stream writing whole lines into `target` with `prefix`.
+
+    Lines are written under `lock`, so several writers may share the
+    target without mixing lines up.
+    """
+
+    def __init__(self, prefix: str, target: TextIO, lock: threading.Lock):
+        self._prefix = prefix
+        self._target = target
+        self._lock = lock
+        self._tail = ""
+
+    def write(self, text: str) -> int:
+        lines = (self._tail + text).split("\n")
+        self._tail = lines.pop()
+        if lines:
+            prefixed = "".join(f"{self._prefix}{line}\n" for line in lines)
+            with self._lock:
+                self._target.write(prefixed)
+
+        return len(text)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._target.flush()
+
+    def close(self) -> None:
+        """Write rest of text, which has no line end yet."""
+        if self._tail:
+            self.write("\n")
+
+        self.flush()
 
 
 def run_command_in_container(
@@ -226,7 +398,7 @@ def run_command_in_container(
     container_info = DOCKER_CLIENT.create_container(
         full_image_name,
         command,
-        user=os.getuid() if "privileged" in host_config else None,
+        user=_UID if "privileged" in host_config else None,
         tty=True,
         stdin_open=True,
         volumes=volumes,
@@ -234,74 +406,110 @@ def run_command_in_container(
     )
     container_id = container_info["Id"]
 
-    exit_info = {"StatusCode": -1}
+    exit_code = -1
     # Using try..finally statement because process running in the
     # container not interractive, therefore all we can do is send
     # interruption to script (Ctrl-C), which will break connection
     # with docker daemon, which will stop container
     try:
+        # Attach before start, as docker CLI does, so no output is lost
+        # and the stream ends when container exits even if it exits
+        # immediately
+        generator = DOCKER_CLIENT.attach(container_id, stream=True,
+                                         stdout=True, stderr=True)
         DOCKER_CLIENT.start(container_id)
-
-        generator = DOCKER_CLIENT.logs(container_id,
-                                       stream=True, follow=True,
-                                       stdout=True, stderr=True)
         print_text(generator)
 
-        exit_info = DOCKER_CLIENT.wait(container_id)
+        exit_code = DOCKER_CLIENT.wait(container_id)["StatusCode"]
     finally:
         DOCKER_CLIENT.remove_container(container_id, v=True, force=True)
 
-    return exit_info["StatusCode"] == 0
+    return exit_code == 0
 
 
 def create_image_builder(
     image_name: str,
     path_to_build_context: str,
     path_to_dockerfile: str = "./Dockerfile",
-    build_args: Dict[str, str] = {}
+    build_args: Optional[Dict[str, str]] = None
 ) -> Callable:
-    def build_image():
+    # Version is resolved only when image is built, so tasks which
+    # don't need it keep working on a detached HEAD
+    def build_image(out: Optional[TextIO] = None):
         full_image_name = construct_tagged_full_image_name(image_name)
+        final_build_args = {VERSION_ENV_VARIABLE: get_version()}
+        if build_args:
+            final_build_args.update(build_args)
+
         output_iter = start_docker_image_building(
             full_image_name,
             path_to_build_context,
             path_to_dockerfile,
-            build_args={VERSION_ENV_VARIABLE: get_version(), **build_args}
+            build_args=final_build_args
         )
-        return analyze_and_print_image_building_status(output_iter)
+        return analyze_and_print_image_building_status(output_iter, out)
 
     return build_image
 
 
-def clean_image(img_name: str) -> None:
+def clean_image(img_name: str) -> bool:
+    """Remove containers and all but latest images of `img_name` image.
+    Returns:
+        True - if all of them are removed
+        False - if removal of any of them fails
+    """
     full_img_name = construct_full_image_name(img_name)
 
-    containers = DOCKER_CLIENT.containers(
-        all=True,
-        filters={"name": full_img_name}
-    )
-    for container in containers:
-        DOCKER_CLIENT.remove_container(container.id, force=True)
-        print(f"{container.id} container removed")
+    # Every removal is a separate request to docker daemon, so they are
+    # sent concurrently. Containers go first, as they may use images.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        containers = DOCKER_CLIENT.containers(
+            all=True,
+            filters={"name": full_img_name}
+        )
+        removals = {
+            executor.submit(DOCKER_CLIENT.remove_container,
+                            container["Id"], force=True):
+            f"{container['Id']} container"
+            for container in containers
+        }
+        if not report_removals(removals):
+            return False
 
-    images = DOCKER_CLIENT.images(name=full_img_name, all=True)
-    images_except_lasp = sorted(images, key=lambda el: el["Created"])[:-1]
-    for image in images_except_lasp:
-        DOCKER_CLIENT.remove_image(image["Id"], force=True)
-        print(f"{img_name} - {image['Id']} image removed")
+        images = DOCKER_CLIENT.images(name=full_img_name, all=True)
+        images_except_lasp = sorted(images, key=lambda el: el["Created"])[:-1]
+        removals = {
+            executor.submit(DOCKER_CLIENT.remove_image,
+                            image["Id"], force=True):
+            f"{img_name} - {image['Id']} image"
+            for image in images_except_lasp
+        }
+        return report_removals(removals)
+
+
+def report_removals(removals: Dict[concurrent.futures.Future, str]) -> bool:
+    """Print result of every removal and tell whether all have succeeded."""
+    is_all_removed = True
+    for future in concurrent.futures.as_completed(removals):
+        try:
+            future.result()
+            print(f"{removals[future]} removed")
+        except docker.errors.APIError as e:
+            print(f"{removals[future]} not removed: {e}")
+            is_all_removed = False
+
+    return is_all_removed
 
 
 def create_image_build_task(
     task_name: str,
     image_name: str,
-    image_builder_args: Dict[str, Any]
+    image_builder: Callable
 ) -> Callable:
     def task():
         return {
             "basename": task_name,
-            "actions": [
-                create_image_builder(image_name, **image_builder_args)
-            ],
+            "actions": [image_builder],
             "verbosity": 2
         }
 
@@ -330,10 +538,13 @@ def create_tasks_for_docker_image_management(
 ):
     task_name_major_part = get_cli_handy_string(img_name)
 
+    image_builder = create_image_builder(img_name, **image_builder_args)
+    IMAGE_BUILDERS.append((img_name, image_builder))
+
     image_build_task = create_image_build_task(
         task_name_major_part,
         img_name,
-        image_builder_args
+        image_builder
     )
     globals()[f"task_{task_name_major_part}"] = image_build_task
     IMAGE_BUILD_TASKS.append(image_build_task)
@@ -344,6 +555,18 @@ def create_tasks_for_docker_image_management(
     IMAGE_CLEAN_TASKS.append(image_clean_task)
 
 
+@register_clean_hook
+def clean_resume() -> None:
+    if RESUME_OUTPUT_DIR.exists():
+        print(RESUME_OUTPUT_DIR)
+        shutil.rmtree(RESUME_OUTPUT_DIR, ignore_errors=True)
+
+
+@register_clean_hook
+def clean_temporary_files() -> None:
+    delete_matching(REPO_MAIN_DIR, ["*.pyc", "__pycache__", "*~"])
+
+
 def task_resume():
     """Build resume as pdf file"""
     def create_output_dir():
@@ -361,27 +584,15 @@ def task_resume():
                 "-output-directory=output",
                 "-jobname=main"
             ],
-            volumes=["/code", "/_/resources", "/_/output"],
-            host_config=DOCKER_CLIENT.create_host_config(
-                privileged=True,
-                binds={
-                    RESUME_SRC_DIR: {"bind": "/code", "mode": "ro"},
-                    RESOURCES_DIR: {"bind": "/_/resources", "mode": "ro"},
-                    RESUME_OUTPUT_DIR: {"bind": "/_/output", "mode": "rw"}
-                }
-            )
+            volumes=_RESUME_VOLUMES,
+            host_config=_RESUME_HOST_CONFIG
         )
 
-    def clean():
-        if RESUME_OUTPUT_DIR.exists():
-            print(RESUME_OUTPUT_DIR)
-            shutil.rmtree(RESUME_OUTPUT_DIR, ignore_errors=True)
-
     return {
         "actions": [create_output_dir, build_resume],
         "targets": [f"{RESUME_OUTPUT_DIR}/main.pdf"],
         "task_dep": ["toollatex"],
-        "clean": [clean],
+        "clean": [clean_resume],
         "verbosity": 2
     }
 
@@ -389,22 +600,12 @@ def task_resume():
 def task_cleanup():
     """Remove useless temporary files"""
     def clean():
-        for task in get_all_tasks():
-            if task is task_cleanup:
-                continue
-
-            attrs = task()
-            if "clean" in attrs:
-                assert callable(attrs["clean"][0])
-                attrs["clean"][0]()
+        for clean_hook in CLEAN_HOOKS:
+            clean_hook()
 
         if BUILD_DIR_ROOT.exists():
             print(BUILD_DIR_ROOT)
-            BUILD_DIR_ROOT.rmdir()
-
-        delete_using_rglob(BUILD_DIR_ROOT, "*.pyc")
-        delete_using_rglob(BUILD_DIR_ROOT, "__pycache__")
-        delete_using_rglob(BUILD_DIR_ROOT, "*~")
+            shutil.rmtree(BUILD_DIR_ROOT, ignore_errors=True)
 
     return {
         "actions": [clean],
@@ -426,10 +627,40 @@ def task_get_version():
 
 def task_build_all_images():
     """Build all required Docker images"""
+    def build_all_images(workers: int) -> bool:
+        lock = threading.Lock()
+
+        def build(img_name: str, image_builder: Callable) -> bool:
+            out = PrefixedWriter(f"[{img_name}] ", sys.stdout, lock)
+            try:
+                return image_builder(out)
+            finally:
+                out.close()
+
+        # Image builds are independent and mostly wait on docker daemon,
+        # so they are run in threads of this single action instead of
+        # parallel doit tasks, which would fight over sys.stdout capturing
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(lambda args: build(*args),
+                                        IMAGE_BUILDERS))
+
+        if not all(results):
+            return False
+
+        print("All images have just been built")
+        return True
+
     return {
         "basename": get_cli_handy_task_name(task_build_all_images),
-        "actions": [lambda: print("All images have just been built")],
-        "task_dep": [task()["basename"] for task in IMAGE_BUILD_TASKS],
+        "actions": [build_all_images],
+        "params": [{
+            "name": "workers",
+            "short": "w",
+            "long": "workers",
+            "type": int,
+            "default": 4,
+            "help": "Number of images built at the same time"
+        }],
         "verbosity": 2
     }
 